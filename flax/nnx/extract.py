@@ -262,6 +262,18 @@ def default_split_fn(
   return NodeStates.from_split(*ctx.split(leaf))
 
 
+def flat_split_fn(
+  ctx: graph.SplitContext, path: KeyPath, prefix: Prefix, leaf: Leaf
+) -> tp.Any:
+  # for states that are only passed through jax and merged back,
+  # skips building the nested State
+  return NodeStates.from_split(*ctx.flatten(leaf))
+
+
+# maximum number of input structures kept in a to_tree prefix_cache
+_PREFIX_CACHE_SIZE = 16
+
+
 def to_tree(
   tree,
   /,
@@ -273,6 +285,7 @@ def to_tree(
   map_non_graph_nodes: bool = False,
   ctxtag: tp.Hashable | None = None,
   check_aliasing: bool = True,
+  prefix_cache: dict[tp.Any, list[tp.Any]] | None = None,
 ) -> tp.Any:
   if prefix is Missing or prefix is None:
     # fast path, no need for prefix broadcasting or consistent aliasing checks
@@ -283,12 +296,23 @@ def to_tree(
         else x,
         tree,
       )
-  leaf_prefixes = broadcast_prefix(
-    prefix,
-    tree,
-    prefix_is_leaf=lambda x: x is None,
-  )
   leaf_keys, treedef = jax.tree_util.tree_flatten_with_path(tree)
+  # the broadcasted prefixes only depend on the prefix and the tree structure,
+  # callers with a fixed prefix can reuse them across calls via prefix_cache
+  leaf_prefixes = (
+    prefix_cache.get(treedef) if prefix_cache is not None else None
+  )
+  if leaf_prefixes is None:
+    leaf_prefixes = broadcast_prefix(
+      prefix,
+      tree,
+      prefix_is_leaf=lambda x: x is None,
+    )
+    if prefix_cache is not None:
+      if len(prefix_cache) >= _PREFIX_CACHE_SIZE:
+        # evict the oldest structure, dicts keep insertion order
+        del prefix_cache[next(iter(prefix_cache))]
+      prefix_cache[treedef] = leaf_prefixes
 
   assert len(leaf_keys) == len(leaf_prefixes)
   leaves_out = []
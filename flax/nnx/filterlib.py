@@ -14,6 +14,7 @@
 
 import builtins
 import dataclasses
+import functools
 from flax.typing import Key, PathParts
 import typing as tp
 
@@ -33,7 +34,19 @@ def to_predicate(filter: Filter) -> Predicate:
   """Converts a Filter to a predicate function.
   See `Using Filters <https://flax.readthedocs.io/en/latest/nnx/filters_guide.html>`__.
   """
-
+  if isinstance(filter, (list, tuple)):
+    # `typed` only applies to the top level, `(True,)` and `(1,)` would
+    # share an entry. The elements are converted through the cache.
+    return _to_predicate(filter)
+  try:
+    hash(filter)
+  except TypeError:
+    # unhashable filters are not cached
+    return _to_predicate(filter)
+  return _cached_to_predicate(filter)
+
+
+def _to_predicate(filter: Filter) -> Predicate:
   if isinstance(filter, str):
     return WithTag(filter)
   elif isinstance(filter, type):
@@ -52,7 +65,17 @@ def to_predicate(filter: Filter) -> Predicate:
   elif isinstance(filter, (list, tuple)):
     return Any(*filter)
   else:
-    raise TypeError(f'Invalid collection filter: {filter:!r}. ')
+    raise TypeError(f'Invalid collection filter: {filter!r}. ')
+
+
+# predicates are immutable, the same filter can share one across calls,
+# typed so that e.g. `True` and `1` get separate entries. Note that the
+# cache keeps strong references to the last 256 filters, including
+# callable filters and any closures they hold.
+_cached_to_predicate = functools.lru_cache(maxsize=256, typed=True)(
+  _to_predicate
+)
+
 
 def filters_to_predicates(
   filters: tp.Sequence[Filter],
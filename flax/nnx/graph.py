@@ -18,9 +18,12 @@ from collections import deque
 import contextlib
 import dataclasses
 import functools
+import operator
 import threading
 import typing as tp
+import warnings
 
+from flax import config
 from flax.nnx import filterlib, reprlib, variablelib
 from flax.nnx import statelib
 from flax.nnx.proxy_caller import (
@@ -30,7 +33,7 @@ from flax.nnx.proxy_caller import (
 )
 from flax.nnx.statelib import FlatState, State
 from flax.nnx.variablelib import Variable, VariableState
-from flax.typing import Key, PathParts, is_key_like
+from flax.typing import Key, Missing, PathParts, is_key_like
 import jax
 import numpy as np
 import treescope  # type: ignore[import-not-found,import-untyped]
@@ -69,6 +72,8 @@ def is_node_leaf(x: tp.Any) -> tpe.TypeGuard[NodeLeaf]:
 class RefMap(tp.MutableMapping[A, B]):
   """A mapping that hashes keys by their identity."""
 
+  __slots__ = ('_mapping',)
+
   def __init__(
       self,
       mapping: tp.Mapping[A, B] | tp.Iterable[tuple[A, B]] | None = None,
@@ -93,6 +98,20 @@ class RefMap(tp.MutableMapping[A, B]):
   def __contains__(self, key: tp.Any) -> bool:
     return id(key) in self._mapping
 
+  def get(self, key: A, default: tp.Any = None) -> tp.Any:
+    # avoid Mapping.get's try/except KeyError on misses
+    entry = self._mapping.get(id(key))
+    if entry is None:
+      return default
+    return entry[1]
+
+  def update(self, other: tp.Any = (), /, **kwargs: tp.Any) -> None:
+    # RefMaps share the same layout, merge them with a single dict.update
+    if type(other) is RefMap and not kwargs:
+      self._mapping.update(other._mapping)
+    else:
+      super().update(other, **kwargs)
+
   def __iter__(self) -> tp.Iterator[A]:
     for key, _ in self._mapping.values():
       yield key
@@ -103,6 +122,10 @@ class RefMap(tp.MutableMapping[A, B]):
 
 @dataclasses.dataclass(frozen=True, slots=True)
 class NodeImplBase(tp.Generic[Node, Leaf, AuxData]):
+  # set by the subclasses, cheaper to check than isinstance in traversals
+  is_graph: tp.ClassVar[bool] = False
+  is_pytree: tp.ClassVar[bool] = False
+
   type: type[Node]
   flatten: tp.Callable[[Node], tuple[tp.Sequence[tuple[Key, Leaf]], AuxData]]
 
@@ -113,6 +136,8 @@ class NodeImplBase(tp.Generic[Node, Leaf, AuxData]):
 
 @dataclasses.dataclass(frozen=True, slots=True)
 class GraphNodeImpl(NodeImplBase[Node, Leaf, AuxData]):
+  is_graph: tp.ClassVar[bool] = True
+
   set_key: tp.Callable[[Node, Key, Leaf], None]
   pop_key: tp.Callable[[Node, Key], Leaf]
   create_empty: tp.Callable[[AuxData], Node]
@@ -122,6 +147,8 @@ class GraphNodeImpl(NodeImplBase[Node, Leaf, AuxData]):
 
 @dataclasses.dataclass(frozen=True, slots=True)
 class PytreeNodeImpl(NodeImplBase[Node, Leaf, AuxData]):
+  is_pytree: tp.ClassVar[bool] = True
+
   unflatten: tp.Callable[[tp.Sequence[tuple[Key, Leaf]], AuxData], Node]
 
 
@@ -171,7 +198,8 @@ def register_pytree_node_type(
 
 
 def is_node(x: tp.Any) -> bool:
-  if type(x) in GRAPH_REGISTRY:
+  node_type = type(x)
+  if node_type in GRAPH_REGISTRY or node_type in PYTREE_REGISTRY:
     return True
   return is_pytree_node(x)
 
@@ -214,10 +242,16 @@ def get_node_impl_for_type(
 
 
 class HashableMapping(tp.Mapping[HA, HB], tp.Hashable):
+  __slots__ = ('_mapping', '_hash')
+
   _mapping: dict[HA, HB] | tp.Mapping[HA, HB]
+  _hash: int | None
 
   def __init__(self, mapping: tp.Mapping[HA, HB], copy: bool = True):
     self._mapping = dict(mapping) if copy else mapping
+    # computed lazily, values are only required to be hashable
+    # if the mapping itself is hashed
+    self._hash = None
 
   def __contains__(self, key: object) -> bool:
     return key in self._mapping
@@ -232,7 +266,13 @@ class HashableMapping(tp.Mapping[HA, HB], tp.Hashable):
     return len(self._mapping)
 
   def __hash__(self) -> int:
-    return hash(tuple(sorted(self._mapping.items())))
+    if self._hash is None:
+      self._hash = hash(frozenset(self._mapping.items()))
+    return self._hash
+
+  def __reduce__(self):
+    # the cached hash depends on the process' hash seed, don't pickle it
+    return type(self), (self._mapping, False)
 
   def __eq__(self, other: tp.Any) -> bool:
     return (
@@ -243,11 +283,18 @@ class HashableMapping(tp.Mapping[HA, HB], tp.Hashable):
     return repr(self._mapping)
 
 
-@dataclasses.dataclass(frozen=True, repr=False)
+@dataclasses.dataclass(frozen=True, repr=False, slots=True)
 class NodeRef(tp.Generic[Node], reprlib.Representable):
   type: type[Node]
   index: int
 
+  # a NodeRef carries no outer index, these mirror NodeDef's methods
+  def with_no_outer_index(self) -> NodeRef[Node]:
+    return self
+
+  def with_same_outer_index(self) -> NodeRef[Node]:
+    return self
+
   def __nnx_repr__(self):
     yield reprlib.Object(type=type(self))
     yield reprlib.Attr('type', self.type.__name__)
@@ -265,7 +312,7 @@ class NodeRef(tp.Generic[Node], reprlib.Representable):
 jax.tree_util.register_static(NodeRef)
 
 
-@dataclasses.dataclass(frozen=True, repr=False)
+@dataclasses.dataclass(frozen=True, repr=False, slots=True)
 class VariableDef(reprlib.Representable):
   type: type[Variable]
   index: int
@@ -273,11 +320,15 @@ class VariableDef(reprlib.Representable):
   metadata: HashableMapping[str, tp.Any]
 
   def with_no_outer_index(self) -> VariableDef:
+    if self.outer_index is None:
+      return self
     return VariableDef(
       type=self.type, index=self.index, outer_index=None, metadata=self.metadata
     )
 
   def with_same_outer_index(self) -> VariableDef:
+    if self.outer_index == self.index:
+      return self
     return VariableDef(
       type=self.type,
       index=self.index,
@@ -308,6 +359,13 @@ class VariableDef(reprlib.Representable):
 jax.tree_util.register_static(VariableDef)
 
 
+# attribute kinds used by NodeDef._children_plan
+_STATIC_ATTR = 0
+_NODE_REF_ATTR = 1
+_NODE_DEF_ATTR = 2
+_VARIABLE_DEF_ATTR = 3
+
+
 @dataclasses.dataclass(frozen=True, repr=False, slots=True)
 class NodeDef(tp.Generic[Node], reprlib.Representable):
   """A dataclass that denotes the tree structure of a
@@ -317,49 +375,111 @@ class NodeDef(tp.Generic[Node], reprlib.Representable):
   type: tp.Type[Node]
   index: int
   outer_index: int | None
-  attributes: tuple[
-    tuple[
-      Key, NodeDef[tp.Any] | VariableDef | NodeRef[tp.Any] | Static[tp.Any]
-    ],
-    ...,
+  # attribute keys and values are stored as parallel tuples
+  attr_keys: tuple[Key, ...]
+  attr_values: tuple[
+    NodeDef[tp.Any] | VariableDef | NodeRef[tp.Any] | Static[tp.Any], ...
   ]
   metadata: tp.Any
+  # set once it is known that with_no_outer_index / with_same_outer_index
+  # would return an equal NodeDef, in which case self is returned
+  _no_outer_index: bool = dataclasses.field(
+    default=False, init=False, repr=False, compare=False
+  )
+  _same_outer_index: bool = dataclasses.field(
+    default=False, init=False, repr=False, compare=False
+  )
+  # built on first unflatten, see _children_plan
+  _plan: tuple[tuple[int, Key, tp.Any], ...] | None = dataclasses.field(
+    default=None, init=False, repr=False, compare=False
+  )
 
   def with_no_outer_index(self) -> NodeDef[Node]:
-    attributes = tuple(
-      (
-        key,
-        value.with_no_outer_index()
-        if isinstance(value, NodeDef | VariableDef)
-        else value,
-      )
-      for key, value in self.attributes
-    )
-    return NodeDef(
+    if self._no_outer_index:
+      return self
+    changed = self.outer_index is not None
+    attr_values = []
+    for value in self.attr_values:
+      if type(value) in _NODEDEF_OR_VARIABLEDEF:
+        new_value = value.with_no_outer_index()
+        if new_value is not value:
+          changed = True
+          value = new_value
+      attr_values.append(value)
+    if not changed:
+      object.__setattr__(self, '_no_outer_index', True)
+      return self
+    nodedef = NodeDef(
       type=self.type,
       index=self.index,
       outer_index=None,
-      attributes=attributes,
+      attr_keys=self.attr_keys,
+      attr_values=tuple(attr_values),
       metadata=self.metadata,
     )
+    object.__setattr__(nodedef, '_no_outer_index', True)
+    return nodedef
 
   def with_same_outer_index(self) -> NodeDef[Node]:
-    attributes = tuple(
-      (
-        key,
-        value.with_same_outer_index()
-        if isinstance(value, NodeDef | VariableDef)
-        else value,
-      )
-      for key, value in self.attributes
-    )
-    return NodeDef(
+    if self._same_outer_index:
+      return self
+    outer_index = self.index if self.index >= 0 else None
+    changed = self.outer_index != outer_index
+    attr_values = []
+    for value in self.attr_values:
+      if type(value) in _NODEDEF_OR_VARIABLEDEF:
+        new_value = value.with_same_outer_index()
+        if new_value is not value:
+          changed = True
+          value = new_value
+      attr_values.append(value)
+    if not changed:
+      object.__setattr__(self, '_same_outer_index', True)
+      return self
+    nodedef = NodeDef(
       type=self.type,
       index=self.index,
-      outer_index=self.index if self.index >= 0 else None,
-      attributes=attributes,
+      outer_index=outer_index,
+      attr_keys=self.attr_keys,
+      attr_values=tuple(attr_values),
       metadata=self.metadata,
     )
+    object.__setattr__(nodedef, '_same_outer_index', True)
+    return nodedef
+
+  def _children_plan(self) -> tuple[tuple[int, Key, tp.Any], ...]:
+    """Returns the attributes as ``(kind, key, payload)`` triples where the
+    payload is what ``_graph_unflatten`` needs for that kind of attribute:
+    the static value, the ``NodeRef`` index, the subgraph ``NodeDef``, or the
+    ``VariableDef``. As NodeDefs are immutable the plan is
+    built once and reused on every subsequent unflatten."""
+    if self._plan is not None:
+      return self._plan
+    plan: list[tuple[int, Key, tp.Any]] = []
+    for key, value in zip(self.attr_keys, self.attr_values):
+      if type(value) is Static:
+        plan.append((_STATIC_ATTR, key, value.value))
+      elif type(value) is NodeRef:
+        plan.append((_NODE_REF_ATTR, key, value.index))
+      elif type(value) is NodeDef:
+        plan.append((_NODE_DEF_ATTR, key, value))
+      elif type(value) is VariableDef:
+        plan.append((_VARIABLE_DEF_ATTR, key, value))
+      else:
+        raise RuntimeError(f'Unknown static field: {key!r}')
+    object.__setattr__(self, '_plan', tuple(plan))
+    return self._plan  # type: ignore[return-value]
+
+  @property
+  def attributes(
+    self,
+  ) -> tuple[
+    tuple[
+      Key, NodeDef[tp.Any] | VariableDef | NodeRef[tp.Any] | Static[tp.Any]
+    ],
+    ...,
+  ]:
+    return tuple(zip(self.attr_keys, self.attr_values))
 
   def replace(self, **kwargs):
     return dataclasses.replace(self, **kwargs)
@@ -406,6 +526,10 @@ class NodeDef(tp.Generic[Node], reprlib.Representable):
 
 jax.tree_util.register_static(NodeDef)
 
+# used by with_*_outer_index, type() membership avoids building a
+# Union and the isinstance MRO walk for every attribute
+_NODEDEF_OR_VARIABLEDEF = frozenset({NodeDef, VariableDef})
+
 GraphDef = tp.Union[NodeDef[Node], NodeRef[Node]]
 PureState = tuple[GraphDef[Node], GraphState]
 
@@ -494,21 +618,30 @@ def flatten(
     ref_index = RefMap()
 
   leaves: list[StateLeaf | Variable[tp.Any]] = []
-  path: list[Key] | None = [] if with_paths else None
   paths: list[PathParts] | None = [] if with_paths else None
   node_impl = get_node_impl(node)
   if node_impl is None:
     raise RuntimeError(f'Unsupported type: {type(node)}, this is a bug.')
-  graphdef = _graph_flatten(
-    node,
-    node_impl,
-    path,
-    ref_index,
-    ref_outer_index,
-    leaves,
-    paths,
-    return_variables,
-  )
+  if config.flax_use_flaxlib and (flaxlib := _get_flaxlib()) is not None:
+    graphdef = flaxlib._graph_flatten(
+      node,
+      node_impl,
+      ref_index._mapping,
+      ref_outer_index._mapping if ref_outer_index is not None else None,
+      leaves,
+      paths,
+      return_variables,
+    )
+  else:
+    graphdef = _graph_flatten(
+      node,
+      node_impl,
+      ref_index,
+      ref_outer_index,
+      leaves,
+      paths,
+      return_variables,
+    )
 
   if paths is not None:
     return graphdef, FlatState.from_sorted_keys_values(tuple(paths), leaves)  # type: ignore[return-value]
@@ -516,99 +649,152 @@ def flatten(
     return graphdef, leaves
 
 
+@functools.cache
+def _get_flaxlib():
+  try:
+    import flaxlib  # type: ignore[import-not-found]
+  except ImportError:
+    warnings.warn(
+      'flax_use_flaxlib is set but flaxlib could not be imported, '
+      'falling back to the Python implementation.'
+    )
+    return None
+  return flaxlib
+
+
 def _graph_flatten(
   node: Node,
   node_impl: NodeImpl[Node, Leaf, AuxData],
-  path: list[Key] | None,
   ref_index: RefMap,
   ref_outer_index: RefMap | None,
   leaves: list[StateLeaf | Variable[tp.Any]],
   paths: list[PathParts] | None,
   return_variables: bool,
 ) -> NodeDef[tp.Any] | NodeRef:
-  is_pytree_node_ = isinstance(node_impl, PytreeNodeImpl)
-  is_graph_node_ = isinstance(node_impl, GraphNodeImpl)
-
-  if not is_pytree_node_ and node in ref_index:
+  """Helper for flatten. The graph is traversed depth-first using an explicit
+  stack of frames instead of recursion so that deep graphs don't run into the
+  recursion limit."""
+  if not node_impl.is_pytree and node in ref_index:
     return NodeRef(type(node), ref_index[node])
 
-  # only cache graph nodes
-  if is_graph_node_:
-    index = len(ref_index)
-    ref_index[node] = index
-  else:
-    index = -1
-
-  attributes: list[
-    tuple[Key, Static[tp.Any] | NodeDef[tp.Any] | VariableDef | NodeRef[tp.Any]]
-  ] = []
-
-  values, metadata = node_impl.flatten(node)
-  for key, value in values:
-    value_node_impl = get_node_impl(value)
-    if path is not None:
-      path.append(key)
-    if value_node_impl is not None:
-      nodedef = _graph_flatten(
-        value,
-        value_node_impl,
-        path,
-        ref_index,
-        ref_outer_index,
-        leaves,
-        paths,
-        return_variables,
-      )
-      attributes.append((key, nodedef))
-    elif isinstance(value, Variable):
-      if value in ref_index:
-        attributes.append((key, NodeRef(type(value), ref_index[value])))
-      else:
-        if return_variables:
-          leaf = value
-        elif path is None:
-          leaf = value.raw_value
+  # path to the current node, shared by all frames
+  path: list[Key] | None = [] if paths is not None else None
+  # suspended parent frames, plain tuples keep the per-node overhead low:
+  # (key, node, node_impl, index, metadata, values, attr_keys, attr_values)
+  stack: list[tuple[tp.Any, ...]] = []
+  node_key: Key | None = None
+
+  while True:
+    # enter node, only cache graph nodes
+    if node_impl.is_graph:
+      index = len(ref_index)
+      ref_index[node] = index
+    else:
+      index = -1
+    values, metadata = node_impl.flatten(node)
+    values = iter(values)
+    attr_keys: list[Key] = []
+    attr_values: list[
+      Static[tp.Any] | NodeDef[tp.Any] | VariableDef | NodeRef[tp.Any]
+    ] = []
+
+    # visit children until a subgraph has to be entered
+    while True:
+      for key, value in values:
+        value_node_impl = get_node_impl(value)
+        if value_node_impl is not None:
+          if not value_node_impl.is_pytree and value in ref_index:
+            attr_keys.append(key)
+            attr_values.append(NodeRef(type(value), ref_index[value]))
+          else:
+            break
+        elif isinstance(value, Variable):
+          if value in ref_index:
+            attr_keys.append(key)
+            attr_values.append(NodeRef(type(value), ref_index[value]))
+          else:
+            if return_variables:
+              leaf = value
+            elif path is None:
+              leaf = value.raw_value
+            else:
+              leaf = value.to_state()  # type: ignore[assignment]
+            leaves.append(leaf)
+            if path is not None:
+              assert paths is not None
+              paths.append((*path, key))
+            variable_index = ref_index[value] = len(ref_index)
+            variabledef = VariableDef(
+              type=type(value),
+              index=variable_index,
+              outer_index=ref_outer_index.get(value, None)
+              if ref_outer_index
+              else None,
+              metadata=HashableMapping(value._var_metadata),
+            )
+            attr_keys.append(key)
+            attr_values.append(variabledef)
         else:
-          leaf = value.to_state()  # type: ignore[assignment]
-        leaves.append(leaf)
-        if path is not None:
-          assert paths is not None
-          paths.append(tuple(path))
-        variable_index = ref_index[value] = len(ref_index)
-        variabledef = VariableDef(
-          type=type(value),
-          index=variable_index,
-          outer_index=ref_outer_index.get(value, None)
-          if ref_outer_index
+          if isinstance(value, (jax.Array, np.ndarray)):
+            if path is not None:
+              path_str = '/'.join(map(str, (*path, key)))
+              raise ValueError(
+                f'Arrays leaves are not supported, at {path_str!r}: {value}'
+              )
+            else:
+              raise ValueError(
+                f'Arrays leaves are not supported, found {value}'
+              )
+          # static_fields.append((key, value))
+          attr_keys.append(key)
+          attr_values.append(Static(value))
+      else:
+        # all children have been visited, create the NodeDef
+        is_graph_node_ = node_impl.is_graph
+        nodedef = NodeDef(
+          type=node_impl.type,  # type: ignore[arg-type]
+          index=index,
+          outer_index=ref_outer_index[node]
+          if is_graph_node_ and ref_outer_index and node in ref_outer_index
           else None,
-          metadata=HashableMapping(value._var_metadata),
+          attr_keys=tuple(attr_keys),
+          attr_values=tuple(attr_values),
+          metadata=metadata,
         )
-        attributes.append((key, variabledef))
-    else:
-      if isinstance(value, (jax.Array, np.ndarray)):
+        if not stack:
+          return nodedef
+        # resume the parent
         if path is not None:
-          path_str = '/'.join(map(str, path))
-          raise ValueError(
-            f'Arrays leaves are not supported, at {path_str!r}: {value}'
-          )
-        else:
-          raise ValueError(f'Arrays leaves are not supported, found {value}')
-      # static_fields.append((key, value))
-      attributes.append((key, Static(value)))
-
-    if path is not None:
-      path.pop()
-
-  nodedef = NodeDef(
-    type=node_impl.type,  # type: ignore[arg-type]
-    index=index,
-    outer_index=ref_outer_index[node]
-    if is_graph_node_ and ref_outer_index and node in ref_outer_index
-    else None,
-    attributes=tuple(attributes),
-    metadata=metadata,
-  )
-  return nodedef
+          path.pop()
+        attr_key = node_key
+        (
+          node_key,
+          node,
+          node_impl,
+          index,
+          metadata,
+          values,
+          attr_keys,
+          attr_values,
+        ) = stack.pop()
+        attr_keys.append(attr_key)
+        attr_values.append(nodedef)
+        continue
+      # suspend the current node and enter the subgraph
+      stack.append((
+        node_key,
+        node,
+        node_impl,
+        index,
+        metadata,
+        values,
+        attr_keys,
+        attr_values,
+      ))
+      if path is not None:
+        path.append(key)
+      node_key, node, node_impl = key, value, value_node_impl
+      break
 
 
 @dataclasses.dataclass(slots=True)
@@ -646,8 +832,8 @@ def _graph_fingerprint(
   ref_index: RefMap,
   new_ref_index: RefMap,
 ):
-  is_pytree_node_ = type(node_impl) is PytreeNodeImpl
-  is_graph_node_ = type(node_impl) is GraphNodeImpl
+  is_pytree_node_ = node_impl.is_pytree
+  is_graph_node_ = node_impl.is_graph
 
   append_fn(type(node))
 
@@ -732,8 +918,8 @@ def _check_graph_fingerprint(
   ref_index: RefMap,
   new_ref_index: RefMap,
 ) -> bool:
-  is_pytree_node_ = type(node_impl) is PytreeNodeImpl
-  is_graph_node_ = type(node_impl) is GraphNodeImpl
+  is_pytree_node_ = node_impl.is_pytree
+  is_graph_node_ = node_impl.is_graph
 
   if type(node) != next(fp_iterator):
     return False
@@ -814,19 +1000,21 @@ def _check_graph_fingerprint(
 
 def _get_sorted_leaves(
   xs: tp.Mapping[tp.Any, tp.Any],
-) -> deque[tp.Any]:
+) -> list[tp.Any]:
   if not isinstance(xs, tp.Mapping):  # type: ignore
     raise TypeError(f'expected Mapping; got {type(xs).__qualname__}')
-  leaves: deque[tp.Any] = deque()
-
-  def _flatten(xs):
-    if not isinstance(xs, tp.Mapping):
-      leaves.append(xs)
+  leaves: list[tp.Any] = []
+  stack: deque[tp.Any] = deque([xs])
+
+  while stack:
+    x = stack.pop()
+    if type(x) is dict or isinstance(x, tp.Mapping):
+      # push in reverse so children are popped in sorted order
+      for _, value in sorted(x.items(), reverse=True):
+        stack.append(value)
     else:
-      for _, value in sorted(xs.items()):
-        _flatten(value)
+      leaves.append(x)
 
-  _flatten(xs)
   return leaves
 
 
@@ -853,12 +1041,13 @@ def unflatten(
       existing graph nodes are mutated to have the new content/topology
       specified by the graphdef.
   """
-  if isinstance(state, (State, dict)):
-    leaves = _get_sorted_leaves(state)
+  # leaves are consumed through an iterator, this avoids copying them
+  if isinstance(state, tp.Mapping):
+    leaves = iter(_get_sorted_leaves(state))
   elif isinstance(state, FlatState):
-    leaves = deque(state.leaves)
+    leaves = iter(state.leaves)
   elif isinstance(state, list):  # type: ignore
-    leaves = deque(state)
+    leaves = iter(state)
   else:
     raise ValueError(f'Unsupported state type: {type(state)}')
   if index_ref is None:
@@ -874,9 +1063,10 @@ def unflatten(
     node = _graph_unflatten(
       graphdef, node_impl, leaves, index_ref, outer_index_outer_ref
     )
-  if leaves:
+  if next(leaves, Missing) is not Missing:
+    num_extra = 1 + sum(1 for _ in leaves)
     raise ValueError(
-      f'Incorrect number of leaves: got an extra {len(leaves)} leaves in the state'
+      f'Incorrect number of leaves: got an extra {num_extra} leaves in the state'
     )
 
   return node
@@ -885,7 +1075,7 @@ def unflatten(
 def _graph_unflatten(
   nodedef: NodeDef[Node] | NodeRef[Node],
   node_impl: NodeImpl[Node, Leaf, AuxData],
-  leaves: deque[tp.Any],
+  leaves: tp.Iterator[tp.Any],
   index_ref: dict[Index, tp.Any],
   outer_index_outer_ref: dict[Index, tp.Any] | None,
 ) -> Node:
@@ -912,12 +1102,12 @@ def _graph_unflatten(
     children: list[tuple[Key, NodeLeaf | Node]] = []  # type: ignore[invalid-annotation]
 
     assert type(nodedef) is NodeDef
-    for key, value in nodedef.attributes:
-      if type(value) is Static:
-        children.append((key, value.value))
-      elif type(value) is NodeRef:
-        children.append((key, index_ref[value.index]))
-      elif type(value) is NodeDef:
+    for kind, key, value in nodedef._children_plan():
+      if kind == _STATIC_ATTR:
+        children.append((key, value))
+      elif kind == _NODE_REF_ATTR:
+        children.append((key, index_ref[value]))
+      elif kind == _NODE_DEF_ATTR:
         # if the key is a subgraph we create an empty node
         subgraphdef = value
         value_node_impl = get_node_impl_for_type(subgraphdef.type)
@@ -926,12 +1116,12 @@ def _graph_unflatten(
           subgraphdef, value_node_impl, leaves, index_ref, outer_index_outer_ref
         )
         children.append((key, subnode))
-      elif type(value) is VariableDef:
+      else:
         variabledef = value
-        if not leaves:
-          raise ValueError('Not enough leaves to unflatten the graph')
         # its a unseen variable, create a new one
-        value = leaves.popleft()
+        value = next(leaves, Missing)
+        if value is Missing:
+          raise ValueError('Not enough leaves to unflatten the graph')
         # when idxmap is present, check if the Varable exists there
         # and update existing variables if it does
         if (
@@ -965,12 +1155,10 @@ def _graph_unflatten(
             )
         children.append((key, variable))
         index_ref[variabledef.index] = variable
-      else:
-        raise RuntimeError(f'Unknown static field: {key!r}')
 
     return children
 
-  if isinstance(node_impl, GraphNodeImpl):
+  if node_impl.is_graph:
     # we create an empty node first and add it to the index
     # this avoids infinite recursion when there is a reference cycle
     assert type(nodedef) is NodeDef
@@ -1020,6 +1208,8 @@ def _graph_pop(
   flat_states: tuple[dict[PathParts, StateLeaf], ...],
   predicates: tuple[filterlib.Predicate, ...],
 ) -> None:
+  """Helper for pop. The graph is traversed depth-first using an explicit
+  stack of ``(node, node_impl, path_parts, children)`` frames."""
   if not is_node(node):
     raise RuntimeError(f'Unsupported type: {type(node)}, this is a bug.')
 
@@ -1030,43 +1220,56 @@ def _graph_pop(
   node_impl = get_node_impl(node)
   if node_impl is None:
     raise TypeError(f'Unknown node type: {type(node)}')
-  node_dict = node_impl.node_dict(node)
-
-  for name, value in node_dict.items():
-    if is_node(value):
-      _graph_pop(
-        node=value,
-        id_to_index=id_to_index,
-        path_parts=(*path_parts, name),
-        flat_states=flat_states,
-        predicates=predicates,
-      )
-      continue
-    elif not is_node_leaf(value):
-      continue
-    elif id(value) in id_to_index:
-      continue
-
-    node_path = (*path_parts, name)
-    node_impl = get_node_impl(node)
-    if node_impl is None:
-      raise TypeError(f'Unknown node type: {type(node)}')
+  stack: deque[
+    tuple[
+      tp.Any,
+      NodeImpl[tp.Any, tp.Any, tp.Any],
+      PathParts,
+      tp.Iterator[tuple[Key, tp.Any]],
+    ]
+  ] = deque()
+  stack.append(
+    (node, node_impl, path_parts, iter(node_impl.node_dict(node).items()))
+  )
 
-    for state, predicate in zip(flat_states, predicates):
-      if predicate(node_path, value):
-        if isinstance(node_impl, PytreeNodeImpl):
-          raise ValueError(
-            f'Cannot pop key {name!r} from node of type {type(node).__name__}'
-          )
+  while stack:
+    node, node_impl, path_parts, children = stack[-1]
+    for name, value in children:
+      value_node_impl = get_node_impl(value)
+      if value_node_impl is not None:
+        if id(value) in id_to_index:
+          continue
+        # visit the subgraph, the current frame resumes once it's done
         id_to_index[id(value)] = len(id_to_index)
-        node_impl.pop_key(node, name)
-        if isinstance(value, Variable):
-          value = value.to_state()
-        state[node_path] = value  # type: ignore[index] # mypy is wrong here?
+        stack.append((
+          value,
+          value_node_impl,
+          (*path_parts, name),
+          iter(value_node_impl.node_dict(value).items()),
+        ))
         break
+      elif not is_node_leaf(value):
+        continue
+      elif id(value) in id_to_index:
+        continue
+
+      node_path = (*path_parts, name)
+      for state, predicate in zip(flat_states, predicates):
+        if predicate(node_path, value):
+          if node_impl.is_pytree:
+            raise ValueError(
+              f'Cannot pop key {name!r} from node of type {type(node).__name__}'
+            )
+          id_to_index[id(value)] = len(id_to_index)
+          node_impl.pop_key(node, name)
+          if isinstance(value, Variable):
+            value = value.to_state()
+          state[node_path] = value  # type: ignore[index] # mypy is wrong here?
+          break
+      # NOTE: should we raise an error if no predicate matched?
     else:
-      # NOTE: should we raise an error here?
-      pass
+      # all children have been visited
+      stack.pop()
 
 
 def _graph_update_dynamic(node: tp.Any, state: tp.Mapping[KeyT, tp.Any]):
@@ -1076,11 +1279,23 @@ def _graph_update_dynamic(node: tp.Any, state: tp.Mapping[KeyT, tp.Any]):
   node_impl = get_node_impl(node)
   if node_impl is None:
     raise TypeError(f'Unknown node type: {type(node)}')
+  _graph_update_dynamic_node(node, node_impl, state)
+
+
+def _graph_update_dynamic_node(
+  node: tp.Any,
+  node_impl: NodeImpl[tp.Any, tp.Any, tp.Any],
+  state: tp.Mapping[KeyT, tp.Any],
+):
+  # node_impl is resolved once per node by the caller and passed down
+  if not state:
+    # nothing to update, avoid flattening the node
+    return
   node_dict = node_impl.node_dict(node)
   for key, value in state.items():
     # case 1: new state is being added
     if key not in node_dict:
-      if isinstance(node_impl, PytreeNodeImpl):
+      if node_impl.is_pytree:
         raise ValueError(
           f'Cannot set key {key!r} on immutable node of '
           f'type {type(node).__name__}'
@@ -1094,10 +1309,11 @@ def _graph_update_dynamic(node: tp.Any, state: tp.Mapping[KeyT, tp.Any]):
     current_value = node_dict[key]
 
     # case 2: subgraph is being updated
-    if is_node(current_value):
+    current_node_impl = get_node_impl(current_value)
+    if current_node_impl is not None:
       if is_state_leaf(value):
         raise ValueError(f'Expected a subgraph for {key!r}, but got: {value!r}')
-      _graph_update_dynamic(current_value, value)
+      _graph_update_dynamic_node(current_value, current_node_impl, value)
     else:
       # case 3: state leaf is being updated
       if not isinstance(current_value, Variable):
@@ -1118,6 +1334,11 @@ def _graph_update_dynamic(node: tp.Any, state: tp.Mapping[KeyT, tp.Any]):
 # --------------------------------------------------------
 
 
+# leaves are read on every cache hit, map these over the cached variables
+_to_state = operator.methodcaller('to_state')
+_get_raw_value = operator.attrgetter('raw_value')
+
+
 class StaticCache(tp.NamedTuple):
   graphdef: GraphDef[tp.Any]
   final_graphdef: GraphDef[tp.Any]
@@ -1134,14 +1355,9 @@ class StaticCache(tp.NamedTuple):
     new_ref_index: RefMap,
   ):
     new_index_ref = {index: obj for obj, index in new_ref_index.items()}
-    final_graphdef: NodeDef[tp.Any] | NodeRef[tp.Any]
-    if type(graphdef) is NodeDef:
-      final_graphdef = graphdef.with_same_outer_index()
-    else:
-      final_graphdef = graphdef
     return StaticCache(
       graphdef=graphdef,
-      final_graphdef=final_graphdef,
+      final_graphdef=graphdef.with_same_outer_index(),
       paths=paths,
       variables=variables,
       new_ref_index=new_ref_index,
@@ -1230,10 +1446,10 @@ def _cached_partial(f: tp.Callable[..., tp.Any], *cached_args):
   cache: RefMap[tp.Any, StaticCache] = RefMap()
   original_ref_index: RefMap = RefMap()
   index_ref: dict[Index, tp.Any] = {}
-  cached_ref_index: RefMap = RefMap()
 
   def create_static_cache(x):
     if is_graph_node(x):
+      start_index = len(original_ref_index)
       graphdef, flat_state = flatten(
         x, with_paths=True, return_variables=True, ref_index=original_ref_index
       )
@@ -1241,13 +1457,11 @@ def _cached_partial(f: tp.Callable[..., tp.Any], *cached_args):
       variables = flat_state.leaves
       # clone but keep the same variable references
       node_cache = unflatten(graphdef, flat_state, index_ref=index_ref)
+      # the clone mirrors x, its new references are the ones unflatten
+      # registered under the indexes flatten just assigned
       cached_new_ref_index = RefMap()
-      _fp = fingerprint(
-        node_cache,
-        ref_index=cached_ref_index,
-        new_ref_index=cached_new_ref_index,
-      )
-      cached_ref_index.update(cached_new_ref_index)
+      for index in range(start_index, len(original_ref_index)):
+        cached_new_ref_index[index_ref[index]] = index
       cache[node_cache] = StaticCache.create(
         graphdef, paths, variables, cached_new_ref_index
       )
@@ -1270,11 +1484,13 @@ else:
   cached_partial = _cached_partial
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class SplitContext:
   ctxtag: tp.Hashable | None
   ref_index: RefMap
   is_inner: bool | None
+  # update context for ctxtag, resolved once by split_context
+  ctx: UpdateContext | None
 
   @tp.overload
   def split(self, graph_node: A, /) -> tuple[GraphDef[A], GraphState]:
@@ -1300,9 +1516,7 @@ class SplitContext:
   def split(
     self, node: A, *filters: filterlib.Filter
   ) -> tuple[GraphDef[A], tpe.Unpack[tuple[GraphState, ...]]]:  # type: ignore[not-supported-yet]
-    ctx = (
-      current_update_context(self.ctxtag) if self.ctxtag is not None else None
-    )
+    ctx = self.ctx
     inner_ref_outer_index = (
       ctx.inner_ref_outer_index if ctx and ctx.inner_ref_outer_index else None
     )
@@ -1371,9 +1585,7 @@ class SplitContext:
     if not with_paths and filters:
       raise ValueError('Cannot use filters with with_paths=False')
 
-    ctx = (
-        current_update_context(self.ctxtag) if self.ctxtag is not None else None
-    )
+    ctx = self.ctx
     static_cache = (
       ctx.static_cache if ctx is not None and self.is_inner is False else None
     )
@@ -1410,14 +1622,10 @@ class SplitContext:
 
       if with_paths:
         paths = node_static_cache.paths
-        leaves = [
-          variable.to_state() for variable in node_static_cache.variables
-        ]
+        leaves = list(map(_to_state, node_static_cache.variables))
       else:
         paths = None
-        leaves = [
-            variable.raw_value for variable in node_static_cache.variables
-        ]
+        leaves = list(map(_get_raw_value, node_static_cache.variables))
     else:
       graphdef, flat_state = flatten(
         node,
@@ -1447,24 +1655,28 @@ class SplitContext:
 def split_context(ctxtag: tp.Hashable | None = None):
   ctx = current_update_context(ctxtag) if ctxtag is not None else None
   is_inner = ctx.outer_ref_outer_index is not None if ctx is not None else None
-  GRAPH_CONTEXT.ref_index_stack.append(SplitContext(ctxtag, RefMap(), is_inner))
+  GRAPH_CONTEXT.ref_index_stack.append(
+    SplitContext(ctxtag, RefMap(), is_inner, ctx)
+  )
 
   try:
     yield GRAPH_CONTEXT.ref_index_stack[-1]
   finally:
     flatten_ctx = GRAPH_CONTEXT.ref_index_stack.pop()
-    if ctxtag is not None:
-      ctx = current_update_context(ctxtag)
+    if ctx is not None:
       ctx.flatten_end(flatten_ctx.ref_index)
     del flatten_ctx.ref_index
     del flatten_ctx.ctxtag
+    del flatten_ctx.ctx
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class MergeContext:
   ctxtag: tp.Hashable | None
   index_ref: dict[Index, tp.Any]
   is_inner: bool | None
+  # update context for ctxtag, resolved once by merge_context
+  ctx: UpdateContext | None
 
   def merge(
     self,
@@ -1473,17 +1685,16 @@ class MergeContext:
     /,
     *states: GraphState,
   ) -> A:
-    ctx = (
-      current_update_context(self.ctxtag) if self.ctxtag is not None else None
-    )
+    ctx = self.ctx
     outer_index_outer_ref = (
       ctx.outer_index_outer_ref if ctx and ctx.outer_index_outer_ref else None
     )
 
-    _state = statelib.merge_state(state, *states)
+    if states:
+      state = statelib.merge_state(state, *states)
     node = unflatten(
       graphdef,
-      _state,
+      state,
       index_ref=self.index_ref,
       outer_index_outer_ref=outer_index_outer_ref,
     )
@@ -1496,9 +1707,7 @@ class MergeContext:
     /,
     *flat_states: GraphFlatState,
   ) -> A:
-    ctx = (
-        current_update_context(self.ctxtag) if self.ctxtag is not None else None
-    )
+    ctx = self.ctx
     static_cache = (
       ctx.static_cache if ctx is not None and self.is_inner is False else None
     )
@@ -1589,23 +1798,24 @@ def merge_context(): ...
 def merge_context(inner: bool | None, ctxtag: tp.Hashable | None): ...
 @contextlib.contextmanager
 def merge_context(inner: bool | None = None, ctxtag: tp.Hashable | None = None):
-  GRAPH_CONTEXT.index_ref_stack.append(MergeContext(ctxtag, {}, inner))
+  ctx = current_update_context(ctxtag) if ctxtag is not None else None
+  GRAPH_CONTEXT.index_ref_stack.append(MergeContext(ctxtag, {}, inner, ctx))
 
   try:
     yield GRAPH_CONTEXT.index_ref_stack[-1]
   finally:
     unflatten_ctx = GRAPH_CONTEXT.index_ref_stack.pop()
     index_ref = unflatten_ctx.index_ref
-    if ctxtag is not None:
+    if ctx is not None:
       if inner is None:
         raise ValueError('inner_merge must be specified when using ctxtag')
-      ctx = current_update_context(ctxtag)
       ctx.unflatten_end(index_ref, inner)
     del unflatten_ctx.index_ref
     del unflatten_ctx.ctxtag
+    del unflatten_ctx.ctx
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class UpdateContext:
   """A context manager for handling complex state updates."""
 
@@ -1765,7 +1975,8 @@ class UpdateContext:
       # inner merge (2)
       index_ref_cache = None
 
-    state = statelib.merge_state(state, *states)
+    if states:
+      state = statelib.merge_state(state, *states)
     index_ref: dict[Index, tp.Any] = {}
     node = unflatten(
       graphdef,
@@ -1782,7 +1993,7 @@ class UpdateContext:
 jax.tree_util.register_static(UpdateContext)
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class UpdateContextManager:
   tag: tp.Hashable
 
@@ -2094,8 +2305,9 @@ def merge(
   Returns:
     The merged :class:`flax.nnx.Module`.
   """
-  _state = statelib.merge_state(state, *states)
-  node = unflatten(graphdef, _state)
+  if states:
+    state = statelib.merge_state(state, *states)
+  node = unflatten(graphdef, state)
   return node
 
 
@@ -2235,15 +2447,18 @@ def state(
     One or more :class:`State` mappings.
   """
   _, flat_state = flatten(node)
-  state = flat_state.to_nested_state()
 
+  # filter the flat state directly, only the selected states are nested
   states: GraphState | tuple[GraphState, ...]
   if len(filters) == 0:
-    states = state
+    states = flat_state.to_nested_state()
   elif len(filters) == 1:
-    states = statelib.filter_state(state, filters[0])
+    states = flat_state.filter(filters[0]).to_nested_state()
   else:
-    states = statelib.filter_state(state, filters[0], filters[1], *filters[2:])
+    states = tuple(
+      flat_state_.to_nested_state()
+      for flat_state_ in flat_state.filter(filters[0], *filters[1:])
+    )
 
   return states
 
@@ -2366,8 +2581,10 @@ def clone(node: Node) -> Node:
   Returns:
     A deep copy of the :class:`Module` object.
   """
-  graphdef, state = split(node)
-  return merge(graphdef, state)
+  # raw leaves are enough, unflatten rebuilds the Variables from the
+  # graphdef's metadata
+  graphdef, leaves = flatten(node, with_paths=False)
+  return unflatten(graphdef, leaves)
 
 
 def call(
@@ -2499,21 +2716,32 @@ def iter_graph(node: tp.Any, /) -> tp.Iterator[tuple[PathParts, tp.Any]]:
 def _iter_graph(
   node: tp.Any, visited: set[int], path_parts: PathParts
 ) -> tp.Iterator[tuple[PathParts, tp.Any]]:
-  if is_node(node):
-    if id(node) in visited:
-      return
-    visited.add(id(node))
+  # iterative post-order walk, frames are (path_parts, node, items iterator)
+  stack: list[tuple[PathParts, tp.Any, tp.Iterator[tuple[Key, tp.Any]]]] = []
+
+  while True:
     node_impl = get_node_impl(node)
     if node_impl is None:
-      raise RuntimeError(f'Unsupported type: {type(node)}, this is a bug.')
-    node_dict = node_impl.node_dict(node)
-    for key, value in node_dict.items():
-      yield from _iter_graph(value, visited, (*path_parts, key))
-
-  yield path_parts, node
+      yield path_parts, node
+    elif id(node) not in visited:
+      visited.add(id(node))
+      stack.append((path_parts, node, iter(node_impl.node_dict(node).items())))
+
+    # move to the next child, yielding nodes whose children are exhausted
+    while stack:
+      parent_path, parent, items = stack[-1]
+      item = next(items, None)
+      if item is not None:
+        key, node = item
+        path_parts = (*parent_path, key)
+        break
+      stack.pop()
+      yield parent_path, parent
+    else:
+      return
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class Static(tp.Generic[A]):
   """An empty pytree node that treats its inner value as static.
   ``value`` must define ``__eq__`` and ``__hash__``.
@@ -2543,25 +2771,34 @@ def is_pytree_node(x: tp.Any) -> bool:
     return False
 
 
+def _dict_key_to_key(key: tp.Any) -> Key:
+  if not is_key_like(key.key):  # type: ignore[not-supported-yet]
+    raise ValueError(
+      f'Invalid key: {key.key}. May be due to its type not being hashable or comparable.'
+    )
+  return key.key
+
+
+# dispatch on the exact key path type, one dict lookup per key
+_KEY_PATH_TO_KEY: dict[type[tp.Any], tp.Callable[[tp.Any], Key]] = {
+  jax.tree_util.SequenceKey: operator.attrgetter('idx'),
+  jax.tree_util.DictKey: _dict_key_to_key,
+  jax.tree_util.FlattenedIndexKey: _dict_key_to_key,
+  jax.tree_util.GetAttrKey: operator.attrgetter('name'),
+}
+
+
 def _key_path_to_key(key: tp.Any) -> Key:
-  if isinstance(key, jax.tree_util.SequenceKey):
-    return key.idx
-  elif isinstance(
-    key, (jax.tree_util.DictKey, jax.tree_util.FlattenedIndexKey)
-  ):
-    if not is_key_like(key.key):  # type: ignore[not-supported-yet]
-      raise ValueError(
-        f'Invalid key: {key.key}. May be due to its type not being hashable or comparable.'
-      )
-    return key.key
-  elif isinstance(key, jax.tree_util.GetAttrKey):
-    return key.name
-  else:
-    return str(key)
+  to_key = _KEY_PATH_TO_KEY.get(type(key))
+  if to_key is not None:
+    return to_key(key)
+  return str(key)
 
 class IndexesPytreeDef(tp.NamedTuple):
   key_index: HashableMapping[Key, int]
   treedef: jax.tree_util.PyTreeDef
+  # True if the keys were already sorted, e.g. FlattenedIndexKey's
+  in_order: bool = False
 
 def _flatten_pytree(pytree: tp.Any):
   leaves, treedef = jax.tree_util.tree_flatten_with_path(
@@ -2571,16 +2808,25 @@ def _flatten_pytree(pytree: tp.Any):
   key_index = HashableMapping(
     {key: i for i, (key, _) in enumerate(nodes)}, copy=False
   )
-  nodes.sort()  # sort by key
-  return nodes, IndexesPytreeDef(key_index, treedef)
+  sorted_nodes = sorted(nodes)  # sort by key
+  # elements are compared by identity first, and keys are unique, so values
+  # are never compared
+  in_order = sorted_nodes == nodes
+  return sorted_nodes, IndexesPytreeDef(key_index, treedef, in_order)
 
 
 def _unflatten_pytree(
   nodes: tuple[tuple[Key, tp.Any], ...], metadata: IndexesPytreeDef
 ):
-  # sort to original order
-  sorted_nodes = sorted(nodes, key=lambda x: metadata.key_index[x[0]])
-  pytree = metadata.treedef.unflatten(value for _, value in sorted_nodes)
+  if metadata.in_order:
+    values = [value for _, value in nodes]
+  else:
+    # scatter back to the original order
+    key_index = metadata.key_index._mapping
+    values = [None] * len(nodes)
+    for key, value in nodes:
+      values[key_index[key]] = value
+  pytree = metadata.treedef.unflatten(values)
   return pytree
 
 
@@ -729,20 +729,36 @@ def _split_state(
 
   # we have n + 1 states, where n is the number of predicates
   # the last state is for values that don't match any predicate
-  flat_states: tuple[list[tuple[PathParts, V]], ...] = tuple(
+  keys: tuple[list[PathParts], ...] = tuple(
     [] for _ in range(len(predicates) + 1)
   )
+  values: tuple[list[V], ...] = tuple([] for _ in range(len(predicates) + 1))
 
-  for path, value in flat_state:
-    for i, predicate in enumerate(predicates):
-      if predicate(path, value):
-        flat_states[i].append((path, value))  # type: ignore[index] # mypy is wrong here?
-        break
-    else:
-      # if we didn't break, set leaf to last state
-      flat_states[-1].append((path, value))  # type: ignore[index] # mypy is wrong here?
+  # a trailing `...` or `True` matches everything that is left,
+  # use it as the fallback instead of evaluating it for every leaf
+  if filters and filters[-1] in (..., True):
+    predicates = predicates[:-1]
+  rest_index = len(predicates)
 
-  return tuple(FlatState(flat_state, sort=False) for flat_state in flat_states)
+  if not predicates:
+    keys[rest_index].extend(flat_state.paths)
+    values[rest_index].extend(flat_state.leaves)
+  else:
+    for path, value in zip(flat_state.paths, flat_state.leaves):
+      for i, predicate in enumerate(predicates):
+        if predicate(path, value):
+          break
+      else:
+        # if we didn't break, set leaf to the fallback state
+        i = rest_index
+      keys[i].append(path)
+      values[i].append(value)
+
+  # flat_state is sorted so each split keeps the same order
+  return tuple(
+    FlatState.from_sorted_keys_values(tuple(keys_), values_)
+    for keys_, values_ in zip(keys, values)
+  )
 
 
 def create_path_filters(state: State):
@@ -62,6 +62,9 @@ class StateSharding(extract.PrefixMapping):
     )
     self._filters = tuple(filter for filter, _ in iterable)
     self._shardings = tuple(axis for _, axis in iterable)
+    self._predicates = tuple(map(filterlib.to_predicate, self._filters))
+    # computed lazily, StateSharding is hashed as static metadata on every call
+    self._hash: int | None = None
 
   @property
   def filters(self) -> tuple[filterlib.Filter, ...]:
@@ -74,8 +77,7 @@ class StateSharding(extract.PrefixMapping):
   def map_prefix(
     self, path: variablelib.PathParts, variable: variablelib.Variable
   ) -> tp.Any:
-    for filter, sharding in zip(self.filters, self.shardings):
-      predicate = filterlib.to_predicate(filter)
+    for predicate, sharding in zip(self._predicates, self._shardings):
       if predicate(path, variable):
         return sharding
     raise ValueError(f'No axis found for {path=}, {variable=}')
@@ -91,7 +93,15 @@ class StateSharding(extract.PrefixMapping):
     )
 
   def __hash__(self):
-    return hash((self.filters, self.shardings))
+    if self._hash is None:
+      self._hash = hash((self.filters, self.shardings))
+    return self._hash
+
+  def __getstate__(self):
+    # the cached hash depends on the process' hash seed, don't pickle it
+    state = self.__dict__.copy()
+    state['_hash'] = None
+    return state
 
 
 def _jit_split_fn(ctx: graph.SplitContext, path, prefix, x):
@@ -333,6 +343,8 @@ def jit(
     else x,
     out_shardings,
   )
+  # in_shardings is fixed, cache its broadcast per input structure
+  prefix_cache: dict[tp.Any, list[tp.Any]] = {}
 
   @functools.wraps(fun)
   def jit_wrapper(*args, **kwargs):
@@ -346,6 +358,7 @@ def jit(
         split_fn=_jit_split_fn,
         check_aliasing=in_shardings is not None or kwarg_shardings is not None,
         ctxtag=jit_wrapper,
+        prefix_cache=prefix_cache,
       )
       pure_args_out, pure_kwargs_out, pure_out = jitted_fn(
         *pure_args, **pure_kwargs
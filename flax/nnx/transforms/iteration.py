@@ -1374,7 +1374,9 @@ class WhileLoopBodyFn:
       pure_val_in, ctxtag='while_loop_body', is_inner=True
     )
     out = self.f(val)
-    pure_out = extract.to_tree(out, ctxtag='while_loop_body')
+    pure_out = extract.to_tree(
+      out, ctxtag='while_loop_body', split_fn=extract.flat_split_fn
+    )
 
     try:
       jax.tree.map(lambda a, b: None, pure_val, pure_out)
@@ -1426,7 +1428,9 @@ def while_loop(cond_fun: tp.Callable[[T], tp.Any],
 
   """
 
-  pure_init_val = extract.to_tree(init_val, ctxtag='while_loop')
+  pure_init_val = extract.to_tree(
+    init_val, ctxtag='while_loop', split_fn=extract.flat_split_fn
+  )
 
   # Adding the expected reference mapping to `pure_init_val` to match
   # `body_fun`'s output pytree structure, to make JAX while_loop happy.
@@ -1455,7 +1459,9 @@ class ForiLoopBodyFn:
 
     val = extract.from_tree(pure_val_in, ctxtag='fori_loop_body', is_inner=True)
     out = self.f(i, val)
-    pure_out = extract.to_tree(out, ctxtag='fori_loop_body')
+    pure_out = extract.to_tree(
+      out, ctxtag='fori_loop_body', split_fn=extract.flat_split_fn
+    )
 
     try:
       jax.tree.map(lambda a, b: None, pure_val, pure_out)
@@ -1519,7 +1525,9 @@ def fori_loop(lower: int, upper: int,
 
   """
 
-  pure_init_val = extract.to_tree(init_val, ctxtag='fori_loop')
+  pure_init_val = extract.to_tree(
+    init_val, ctxtag='fori_loop', split_fn=extract.flat_split_fn
+  )
 
   # Adding the expected reference mapping to `pure_init_val` to match
   # `body_fun`'s output pytree structure, to make JAX happy.
@@ -14,3 +14,4 @@
 
 from .flaxlib_cpp import RefMap as RefMap
 from .flaxlib_cpp import _graph_fingerprint as _graph_fingerprint
+from .flaxlib_cpp import _graph_flatten as _graph_flatten
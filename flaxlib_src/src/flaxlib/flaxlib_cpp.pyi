@@ -22,4 +22,14 @@ def _graph_fingerprint(
   ref_index: RefMap,
   new_ref_index: RefMap,
   next_index: int,
-) -> tuple[tuple[tp.Any, ...], int]: ...
\ No newline at end of file
+) -> tuple[tuple[tp.Any, ...], int]: ...
+
+def _graph_flatten(
+  node,
+  node_impl,
+  ref_index: dict[int, tuple[tp.Any, int]],
+  ref_outer_index: dict[int, tuple[tp.Any, int]] | None,
+  leaves: list[tp.Any],
+  paths: list[tuple[tp.Any, ...]] | None,
+  return_variables: bool,
+) -> tp.Any: ...
@@ -108,6 +108,11 @@ namespace flaxlib
     nb::type_object Object;
     nb::type_object Variable;
     nb::object get_node_impl;
+    nb::type_object NodeDef;
+    nb::type_object VariableDef;
+    nb::type_object NodeRef;
+    nb::type_object Static;
+    nb::type_object HashableMapping;
 
     PythonContext()
     {
@@ -122,6 +127,11 @@ namespace flaxlib
       Object = nnx.attr("Object");
       Variable = graph.attr("Variable");
       get_node_impl = graph.attr("get_node_impl");
+      NodeDef = graph.attr("NodeDef");
+      VariableDef = graph.attr("VariableDef");
+      NodeRef = graph.attr("NodeRef");
+      Static = graph.attr("Static");
+      HashableMapping = graph.attr("HashableMapping");
     }
 
     ~PythonContext()
@@ -135,6 +145,11 @@ namespace flaxlib
       PytreeNodeImpl.release();
       Variable.release();
       get_node_impl.release();
+      NodeDef.release();
+      VariableDef.release();
+      NodeRef.release();
+      Static.release();
+      HashableMapping.release();
     }
   };
 
@@ -149,6 +164,31 @@ namespace flaxlib
     return *_python_context;
   }
 
+  //---------------------------------------------------------------
+  // RefMap helpers
+  //---------------------------------------------------------------
+
+  // python's RefMap stores its entries in a dict of id(obj) -> (obj, index)
+  nb::object _ref_map_key(nb::handle obj)
+  {
+    return nb::steal(PyLong_FromVoidPtr(obj.ptr()));
+  }
+
+  PyObject *_ref_map_find(nb::handle mapping, nb::handle key)
+  {
+    PyObject *entry = PyDict_GetItemWithError(mapping.ptr(), key.ptr());
+    if (entry == nullptr && PyErr_Occurred())
+    {
+      throw nb::python_error();
+    }
+    return entry;
+  }
+
+  nb::object _ref_map_index(PyObject *entry)
+  {
+    return nb::borrow(PyTuple_GET_ITEM(entry, 1));
+  }
+
   //---------------------------------------------------------------
   // fingerprint
   //---------------------------------------------------------------
@@ -288,11 +328,286 @@ namespace flaxlib
     return nb::make_tuple(node_fp, next_index);
   }
 
+  //---------------------------------------------------------------
+  // flatten
+  //---------------------------------------------------------------
+
+  struct FlattenContext
+  {
+    PythonContext &py;
+    nb::dict ref_index;
+    nb::object ref_outer_index;
+    nb::list leaves;
+    nb::object paths;
+    nb::list path;
+    bool with_paths;
+    bool return_variables;
+  };
+
+  // a node whose children are being visited, the graph is traversed with an
+  // explicit stack of frames so deep graphs can't overflow the C stack
+  struct FlattenFrame
+  {
+    nb::object key;
+    nb::object node;
+    nb::object node_impl;
+    nb::object node_key;
+    bool is_graph_node;
+    nb::object index;
+    nb::object metadata;
+    nb::object values;
+    nb::list attr_keys;
+    nb::list attr_values;
+  };
+
+  void _flatten_push_frame(
+      FlattenContext &ctx,
+      std::vector<FlattenFrame> &stack,
+      nb::handle key,
+      nb::handle node,
+      nb::handle node_impl)
+  {
+    PythonContext &py = ctx.py;
+    bool is_graph_node = node_impl.type().is(py.GraphNodeImpl);
+    nb::object node_key = _ref_map_key(node);
+
+    // only cache graph nodes
+    nb::object index;
+    if (is_graph_node)
+    {
+      index = nb::int_(PyDict_Size(ctx.ref_index.ptr()));
+      ctx.ref_index[node_key] = nb::make_tuple(node, index);
+    }
+    else
+    {
+      index = nb::int_(-1);
+    }
+
+    nb::object values_metadata = node_impl.attr("flatten")(node);
+    nb::object values = nb::steal(PyObject_GetIter(values_metadata[0].ptr()));
+    if (!values.is_valid())
+    {
+      throw nb::python_error();
+    }
+
+    stack.push_back(FlattenFrame{
+        nb::borrow(key),
+        nb::borrow(node),
+        nb::borrow(node_impl),
+        node_key,
+        is_graph_node,
+        index,
+        values_metadata[1],
+        values,
+        nb::list(),
+        nb::list(),
+    });
+  }
+
+  nb::object _flatten_pop_frame(
+      FlattenContext &ctx,
+      std::vector<FlattenFrame> &stack)
+  {
+    FlattenFrame frame = std::move(stack.back());
+    stack.pop_back();
+
+    nb::object outer_index = nb::none();
+    if (frame.is_graph_node && !ctx.ref_outer_index.is_none())
+    {
+      PyObject *outer_entry = _ref_map_find(ctx.ref_outer_index, frame.node_key);
+      if (outer_entry != nullptr)
+      {
+        outer_index = _ref_map_index(outer_entry);
+      }
+    }
+
+    nb::object nodedef = ctx.py.NodeDef(
+        frame.node_impl.attr("type"),
+        frame.index,
+        outer_index,
+        nb::tuple(frame.attr_keys),
+        nb::tuple(frame.attr_values),
+        frame.metadata);
+
+    if (!stack.empty())
+    {
+      stack.back().attr_keys.append(frame.key);
+      stack.back().attr_values.append(nodedef);
+    }
+    return nodedef;
+  }
+
+  nb::object _graph_flatten(
+      nb::object &node,
+      nb::object &node_impl,
+      nb::dict &ref_index,
+      nb::object &ref_outer_index,
+      nb::list &leaves,
+      nb::object &paths,
+      bool return_variables)
+  {
+    auto &py = get_python_context();
+    FlattenContext ctx{
+        py,
+        ref_index,
+        ref_outer_index,
+        leaves,
+        paths,
+        nb::list(),
+        !paths.is_none(),
+        return_variables,
+    };
+
+    if (!node_impl.type().is(py.PytreeNodeImpl))
+    {
+      PyObject *entry = _ref_map_find(ctx.ref_index, _ref_map_key(node));
+      if (entry != nullptr)
+      {
+        return py.NodeRef(node.type(), _ref_map_index(entry));
+      }
+    }
+
+    std::vector<FlattenFrame> stack;
+    _flatten_push_frame(ctx, stack, nb::none(), node, node_impl);
+
+    while (true)
+    {
+      // the frame is only valid until a new frame is pushed
+      FlattenFrame &frame = stack.back();
+      bool entered_subgraph = false;
+      PyObject *item;
+      while ((item = PyIter_Next(frame.values.ptr())) != nullptr)
+      {
+        nb::object key_value = nb::steal(item);
+        nb::object key = key_value[0];
+        nb::object value = key_value[1];
+        // the key stays on the path while a subgraph is visited
+        if (ctx.with_paths)
+        {
+          ctx.path.append(key);
+        }
+        nb::object value_node_impl = py.get_node_impl(value);
+        if (!value_node_impl.is_none())
+        {
+          PyObject *entry = nullptr;
+          if (!value_node_impl.type().is(py.PytreeNodeImpl))
+          {
+            entry = _ref_map_find(ctx.ref_index, _ref_map_key(value));
+          }
+          if (entry == nullptr)
+          {
+            _flatten_push_frame(ctx, stack, key, value, value_node_impl);
+            entered_subgraph = true;
+            break;
+          }
+          frame.attr_values.append(py.NodeRef(value.type(), _ref_map_index(entry)));
+        }
+        else if (nb::isinstance(value, py.Variable))
+        {
+          nb::object value_key = _ref_map_key(value);
+          PyObject *entry = _ref_map_find(ctx.ref_index, value_key);
+          if (entry != nullptr)
+          {
+            frame.attr_values.append(py.NodeRef(value.type(), _ref_map_index(entry)));
+          }
+          else
+          {
+            nb::object leaf;
+            if (ctx.return_variables)
+            {
+              leaf = value;
+            }
+            else if (!ctx.with_paths)
+            {
+              leaf = value.attr("raw_value");
+            }
+            else
+            {
+              leaf = value.attr("to_state")();
+            }
+            ctx.leaves.append(leaf);
+            if (ctx.with_paths)
+            {
+              ctx.paths.attr("append")(nb::tuple(ctx.path));
+            }
+            nb::object variable_index = nb::int_(PyDict_Size(ctx.ref_index.ptr()));
+            ctx.ref_index[value_key] = nb::make_tuple(value, variable_index);
+            nb::object outer_index = nb::none();
+            if (!ctx.ref_outer_index.is_none())
+            {
+              PyObject *outer_entry = _ref_map_find(ctx.ref_outer_index, value_key);
+              if (outer_entry != nullptr)
+              {
+                outer_index = _ref_map_index(outer_entry);
+              }
+            }
+            frame.attr_values.append(py.VariableDef(
+                value.type(),
+                variable_index,
+                outer_index,
+                py.HashableMapping(value.attr("_var_metadata"))));
+          }
+        }
+        else // static attribute
+        {
+          if (nb::isinstance(value, py.jax_Array) || nb::isinstance(value, py.np_ndarray))
+          {
+            nb::str message;
+            if (ctx.with_paths)
+            {
+              nb::list parts;
+              for (nb::handle part : ctx.path)
+              {
+                parts.append(nb::str(part));
+              }
+              nb::object path_str = nb::str("/").attr("join")(parts);
+              message = nb::str("Arrays leaves are not supported, at {!r}: {}").format(path_str, value);
+            }
+            else
+            {
+              message = nb::str("Arrays leaves are not supported, found {}").format(value);
+            }
+            PyErr_SetObject(PyExc_ValueError, message.ptr());
+            throw nb::python_error();
+          }
+          frame.attr_values.append(py.Static(value));
+        }
+        frame.attr_keys.append(key);
+        if (ctx.with_paths)
+        {
+          PyList_SetSlice(ctx.path.ptr(), nb::len(ctx.path) - 1, nb::len(ctx.path), nullptr);
+        }
+      }
+      if (entered_subgraph)
+      {
+        continue;
+      }
+      if (PyErr_Occurred())
+      {
+        throw nb::python_error();
+      }
+
+      // all children have been visited, create the NodeDef
+      nb::object nodedef = _flatten_pop_frame(ctx, stack);
+      if (stack.empty())
+      {
+        return nodedef;
+      }
+      if (ctx.with_paths)
+      {
+        PyList_SetSlice(ctx.path.ptr(), nb::len(ctx.path) - 1, nb::len(ctx.path), nullptr);
+      }
+    }
+  }
+
   NB_MODULE(flaxlib_cpp, m)
   {
     // Remove the conflicting binding
     nb::bind_map<RefMap>(m, "RefMap")
         .def("get", &ref_map_get, nb::arg("key").none(), nb::arg("default_value").none());
     m.def("_graph_fingerprint", &_graph_fingerprint);
+    m.def("_graph_flatten", &_graph_flatten, nb::arg("node"), nb::arg("node_impl"),
+          nb::arg("ref_index"), nb::arg("ref_outer_index").none(), nb::arg("leaves"),
+          nb::arg("paths").none(), nb::arg("return_variables"));
   }
 } // namespace flaxlib
\ No newline at end of file
@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from unittest import mock
+
 from absl.testing import absltest
 
 from flax import nnx
@@ -31,5 +33,36 @@ class TestFilters(absltest.TestCase):
     self.assertIn('head', head_state)
     self.assertNotIn('backbone', head_state)
 
+  def test_to_predicate_cache(self):
+    to_predicate = nnx.filterlib.to_predicate
+
+    self.assertIs(to_predicate(nnx.Param), to_predicate(nnx.Param))
+    self.assertIsInstance(to_predicate(True), nnx.filterlib.Everything)
+    self.assertIsInstance(to_predicate([nnx.Param, 'a']), nnx.filterlib.Any)
+    with self.assertRaises(TypeError):
+      to_predicate(1)
+    with self.assertRaises(TypeError):
+      to_predicate([nnx.Param, 1])
+
+  def test_to_predicate_nested_filters(self):
+    to_predicate = nnx.filterlib.to_predicate
+
+    # equal containers with differently typed elements
+    self.assertIsInstance(to_predicate((True,)), nnx.filterlib.Any)
+    with self.assertRaises(TypeError):
+      to_predicate((1,))
+    with self.assertRaises(TypeError):
+      to_predicate((1.0,))
+
+  def test_to_predicate_invalid_hashable_filter(self):
+    filterlib = nnx.filterlib
+    with mock.patch.object(
+      filterlib, '_to_predicate', wraps=filterlib._to_predicate
+    ) as uncached:
+      with self.assertRaises(TypeError):
+        filterlib.to_predicate(2.5)
+      # only the cached conversion runs for hashable filters
+      uncached.assert_not_called()
+
 if __name__ == '__main__':
   absltest.main()
@@ -15,11 +15,14 @@
 from collections.abc import Callable
 import dataclasses
 from functools import partial
+import pickle
+import sys
 from threading import Thread
 from typing import Any
 
 from absl.testing import absltest, parameterized
 from flax import linen, nnx, struct
+from flax.configurations import temp_flip_flag
 import jax
 import jax.numpy as jnp
 
@@ -89,6 +92,163 @@ class TestGraphUtils(absltest.TestCase):
     assert a['b'] in refmap
     assert g[3] in refmap
 
+  def test_refmap_identity(self):
+    x = jnp.zeros(3)
+    y = jnp.zeros(3)
+    refmap = nnx.graph.RefMap([(x, 0)])
+
+    assert x in refmap
+    assert y not in refmap
+    assert refmap.get(x) == 0
+    assert refmap.get(y) is None
+    assert refmap.get(y, -1) == -1
+
+    refmap.update(nnx.graph.RefMap([(y, 1)]))
+    assert refmap[x] == 0
+    assert refmap[y] == 1
+
+  def test_flatten_deep_graph(self):
+    # deeper than the recursion limit
+    depth = sys.getrecursionlimit() + 100
+    node = Dict(a=nnx.Param(1))
+    for _ in range(depth):
+      node = Dict(child=node)
+
+    graphdef, flat_state = nnx.graph.flatten(node)
+
+    assert len(flat_state) == 1
+    assert flat_state[0][0] == ('items', 'child') * depth + ('items', 'a')
+    assert flat_state[0][1].value == 1
+
+    # paths of siblings visited after the subgraph
+    node = Dict(child=node, z=nnx.Param(2))
+    _, flat_state = nnx.graph.flatten(node)
+
+    assert flat_state[1][0] == ('items', 'z')
+
+  def test_flatten_flaxlib(self):
+    try:
+      import flaxlib  # noqa: F401
+    except ImportError:
+      self.skipTest('flaxlib is not installed')
+
+    a = Dict(a=1, b=nnx.Param(2))
+    g = List([a, 3, a, nnx.Param(4), {'c': (5, nnx.Param(6))}])
+
+    for kwargs in [{}, {'with_paths': False}, {'return_variables': True}]:
+      graphdef, flat_state = nnx.graph.flatten(g, **kwargs)
+      with temp_flip_flag('use_flaxlib', True):
+        graphdef_c, flat_state_c = nnx.graph.flatten(g, **kwargs)
+
+      self.assertEqual(graphdef, graphdef_c)
+      if kwargs.get('with_paths', True):
+        self.assertEqual(flat_state.paths, flat_state_c.paths)
+        flat_state, flat_state_c = flat_state.leaves, flat_state_c.leaves
+      self.assertEqual(
+        jax.tree.leaves(flat_state), jax.tree.leaves(flat_state_c)
+      )
+
+    # deep enough to overflow the C stack if traversed recursively
+    deep = Dict(a=nnx.Param(1))
+    for _ in range(20000):
+      deep = Dict(child=deep, z=2)
+
+    _, flat_state = nnx.graph.flatten(deep)
+    with temp_flip_flag('use_flaxlib', True):
+      _, flat_state_c = nnx.graph.flatten(deep)
+
+    self.assertEqual(flat_state.paths, flat_state_c.paths)
+    self.assertEqual(
+      jax.tree.leaves(flat_state.leaves), jax.tree.leaves(flat_state_c.leaves)
+    )
+
+  def test_pop_deep_graph(self):
+    class Node(nnx.Module):
+      def __init__(self, child):
+        self.child = child
+
+    # deeper than the default recursion limit
+    leaf = Node(None)
+    leaf.a = nnx.BatchStat(1)
+    leaf.b = nnx.Param(2)
+    root = leaf
+    for _ in range(2000):
+      root = Node(root)
+
+    state = nnx.pop(root, nnx.BatchStat)
+
+    assert nnx.to_flat_state(state)[0][0] == ('child',) * 2000 + ('a',)
+    assert not hasattr(leaf, 'a')
+    assert leaf.b.value == 2
+
+  def test_is_node(self):
+    class Pair:
+      def __init__(self, a, b):
+        self.a, self.b = a, b
+
+    assert not nnx.graph.is_node(Pair(1, 2))
+
+    # registered only with nnx, not with jax
+    nnx.graph.register_pytree_node_type(
+      Pair,
+      lambda p: ((('a', p.a), ('b', p.b)), None),
+      lambda nodes, _: Pair(*(v for _, v in nodes)),
+    )
+    try:
+      assert nnx.graph.is_node(Pair(1, 2))
+    finally:
+      del nnx.graph.PYTREE_REGISTRY[Pair]
+
+    assert not nnx.graph.is_node(Pair(1, 2))
+    assert nnx.graph.is_node(Dict(a=1))
+    assert nnx.graph.is_node((1, 2))
+    assert not nnx.graph.is_node(nnx.Param(1))
+    assert not nnx.graph.is_node(1)
+
+  def test_iter_graph_deep_graph(self):
+    # deeper than the default recursion limit
+    node = Dict(a=nnx.Param(1))
+    for _ in range(2000):
+      node = Dict(child=node)
+
+    paths = [path for path, _ in nnx.iter_graph(node)]
+
+    assert ('items', 'child') * 2000 + ('items', 'a') in paths
+    assert paths[-1] == ()
+
+  def test_hashable_mapping_pickle(self):
+    mapping = nnx.graph.HashableMapping({'a': 1, 'b': 2})
+    hash(mapping)
+    # simulate a hash computed under a different hash seed
+    mapping._hash = 0
+
+    loaded = pickle.loads(pickle.dumps(mapping))
+
+    fresh = nnx.graph.HashableMapping({'a': 1, 'b': 2})
+    self.assertEqual(loaded, fresh)
+    self.assertEqual(hash(loaded), hash(fresh))
+
+    graphdef, _ = nnx.split(List([Dict(a=nnx.Param(1), b=2), 3]))
+    loaded = pickle.loads(pickle.dumps(graphdef))
+    self.assertEqual(hash(loaded), hash(graphdef))
+    self.assertIn(loaded, {graphdef: 1})
+
+  def test_with_outer_index_shares_unchanged(self):
+    a = Dict(a=1, b=nnx.Param(2))
+    g = List([a, 3, a, nnx.Param(4)])
+
+    graphdef, _ = nnx.split(g)
+    assert graphdef.with_no_outer_index() is graphdef
+
+    same = graphdef.with_same_outer_index()
+    assert same is not graphdef
+    assert same.with_same_outer_index() is same
+    assert same.with_no_outer_index() == graphdef
+
+    ref = nnx.graph.NodeRef(List, 0)
+    assert ref.with_no_outer_index() is ref
+    assert ref.with_same_outer_index() is ref
+
   def test_unflatten(self):
     a = Dict(a=1, b=nnx.Param(2))
     g = List([a, 3, a, nnx.Param(4)])
@@ -129,6 +289,17 @@ class TestGraphUtils(absltest.TestCase):
     ):
       nnx.graph.unflatten(graphdef, nnx.State({}))
 
+  def test_unflatten_extra_leaves(self):
+    a = Dict({'a': 1, 'b': nnx.Param(2)})
+    g = List([a, 3, a, nnx.Param(4)])
+
+    graphdef, leaves = nnx.graph.flatten(g, with_paths=False)
+
+    with self.assertRaisesRegex(
+      ValueError, 'got an extra 2 leaves in the state'
+    ):
+      nnx.graph.unflatten(graphdef, [*leaves, 5, 6])
+
   def test_unflatten_return_variables(self):
     a = Dict({'a': 1, 'b': nnx.Param(2)})
     g = List([a, 3, a, nnx.Param(4)])
@@ -334,6 +505,27 @@ class TestGraphUtils(absltest.TestCase):
     assert isinstance(p2, Tree)
     assert p2.a == 1
 
+  def test_pytree_flatten_key_order(self):
+    @struct.dataclass
+    class Tree:
+      b: int
+      a: int
+
+    p = Tree(1, 2)
+
+    leaves, treedef = nnx.graph._flatten_pytree(p)
+
+    assert [key for key, _ in leaves] == ['a', 'b']
+    assert not treedef.in_order
+    assert nnx.graph._unflatten_pytree(leaves, treedef) == p
+
+    # array values are never compared
+    leaves, treedef = nnx.graph._flatten_pytree(Tree(jnp.ones(2), jnp.zeros(2)))
+    assert [key for key, _ in leaves] == ['a', 'b']
+    assert not treedef.in_order
+    _, treedef = nnx.graph._flatten_pytree((jnp.ones(2), jnp.zeros(2)))
+    assert treedef.in_order
+
   def test_pytree_node(self):
     @struct.dataclass
     class Tree:
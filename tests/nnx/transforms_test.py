@@ -14,6 +14,7 @@
 
 import dataclasses
 from functools import partial
+import pickle
 import typing as tp
 
 from absl.testing import absltest
@@ -395,6 +396,55 @@ class TestJIT(absltest.TestCase):
 
     self.assertIsInstance(m.kernel.value.sharding, jax.sharding.NamedSharding)
 
+  def test_in_shardings_different_structures(self):
+    sharding = jax.sharding.SingleDeviceSharding(jax.devices()[0])
+    state_sharding = nnx.StateSharding({...: sharding})
+
+    @nnx.jit(in_shardings=(state_sharding, None))
+    def f(m, x):
+      return jax.tree.leaves(x)
+
+    m = nnx.Linear(2, 3, rngs=nnx.Rngs(0))
+    self.assertLen(f(m, 1.0), 1)
+    self.assertLen(f(m, (1.0, 2.0)), 2)
+    self.assertLen(f(m, 1.0), 1)
+
+  def test_to_tree_prefix_cache_is_bounded(self):
+    m = nnx.Linear(2, 3, rngs=nnx.Rngs(0))
+    prefix_cache = {}
+    size = nnx.extract._PREFIX_CACHE_SIZE
+
+    for n in range(size + 2):
+      nnx.extract.to_tree(
+        (m, (0,) * n), prefix=(None, None), prefix_cache=prefix_cache
+      )
+
+    self.assertLen(prefix_cache, size)
+    # the oldest structures were evicted
+    self.assertNotIn(jax.tree.structure((m, ())), prefix_cache)
+    self.assertIn(jax.tree.structure((m, (0,) * (size + 1))), prefix_cache)
+
+  def test_state_sharding_hash(self):
+    s1 = nnx.StateSharding({nnx.Param: 'a', ...: None})
+    s2 = nnx.StateSharding({nnx.Param: 'a', ...: None})
+
+    self.assertEqual(s1, s2)
+    self.assertEqual(hash(s1), hash(s2))
+    self.assertEqual(hash(s1), hash(s1))
+
+  def test_state_sharding_pickle(self):
+    s1 = nnx.StateSharding({nnx.Param: 'a', ...: None})
+    hash(s1)
+    # simulate a hash computed under a different hash seed
+    s1._hash = 0
+
+    loaded = pickle.loads(pickle.dumps(s1))
+
+    s2 = nnx.StateSharding({nnx.Param: 'a', ...: None})
+    self.assertEqual(loaded, s2)
+    self.assertEqual(hash(loaded), hash(s2))
+    self.assertEqual(s1._hash, 0)
+
   def test_cache_args(self):
     m = nnx.Linear(2, 3, rngs=nnx.Rngs(0))
 